@@ -3,6 +3,8 @@ import email_archiver
 import sqlite3
 from dateutil import parser
 import threading
+import signal
+import sys
 from dotenv import load_dotenv
 from email_archiver import initialize_database
 
@@ -23,7 +25,7 @@ app.jinja_env.filters['format_date'] = format_date
 
 @app.route('/')
 def index():
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     cursor = conn.cursor()
 
     # Fetch the latest archived emails
@@ -53,7 +55,7 @@ def create_account():
         protocol = request.form['protocol']
         server = request.form['server']
         port = request.form['port']
-        conn = sqlite3.connect('email_archive.db')
+        conn = email_archiver.connect_database()
         try:
             email_archiver.create_account(conn, email, password, protocol, server, port)
             conn.close()
@@ -66,14 +68,14 @@ def create_account():
 
 @app.route('/list_accounts')
 def list_accounts():
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     accounts = email_archiver.read_accounts(conn)
     conn.close()
     return render_template('list_accounts.html', accounts=accounts)
 
 @app.route('/update_account/<int:account_id>', methods=['GET', 'POST'])
 def update_account(account_id):
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
@@ -90,7 +92,7 @@ def update_account(account_id):
 
 @app.route('/delete_account/<int:account_id>', methods=['GET', 'POST'])
 def delete_account(account_id):
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     if request.method == 'POST':
         email_archiver.delete_account(conn, account_id)
         conn.close()
@@ -103,7 +105,7 @@ def delete_account(account_id):
 def search_emails():
     if request.method == 'POST':
         query = request.form['query']
-        conn = sqlite3.connect('email_archive.db')
+        conn = email_archiver.connect_database()
         emails = email_archiver.search_emails(conn, query)
         conn.close()
         return render_template('search_emails.html', emails=emails, query=query)
@@ -111,17 +113,15 @@ def search_emails():
 
 @app.route('/email_details/<int:email_id>')
 def email_details(email_id):
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     email, attachments, attachment_filenames = email_archiver.get_email_details(conn, email_id)
     conn.close()
     return render_template('email_details.html', email=email, attachments=attachments, attachment_filenames=attachment_filenames)
 
 @app.route('/download_attachment/<int:attachment_id>')
 def download_attachment(attachment_id):
-    conn = sqlite3.connect('email_archive.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT filename, content FROM attachments WHERE id = ?", (attachment_id,))
-    attachment = cursor.fetchone()
+    conn = email_archiver.connect_database()
+    attachment = email_archiver.get_attachment(conn, attachment_id)
     conn.close()
     
     if attachment:
@@ -135,7 +135,7 @@ def download_attachment(attachment_id):
     
 @app.route('/export_email/<int:email_id>')
 def export_email(email_id):
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     email_data = email_archiver.export_email(conn, email_id)
     conn.close()
     
@@ -149,7 +149,7 @@ def export_email(email_id):
 
 @app.route('/export_all_emails')
 def export_all_emails():
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     zip_data = email_archiver.export_all_emails(conn)
     conn.close()
     
@@ -161,7 +161,7 @@ def export_all_emails():
 @app.route('/export_search_results', methods=['POST'])
 def export_search_results():
     query = request.form['query']
-    conn = sqlite3.connect('email_archive.db')
+    conn = email_archiver.connect_database()
     zip_data = email_archiver.export_search_results(conn, query)
     conn.close()
     
@@ -180,6 +180,8 @@ if __name__ == '__main__':
     archiver_thread = threading.Thread(target=run_archiver_thread)
     archiver_thread.daemon = True
     archiver_thread.start()
+    # Exit normally on SIGTERM, so the archiver flushes its queued writes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     
     # Run the Flask app
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
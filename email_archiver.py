@@ -1,17 +1,29 @@
 import argparse
+import atexit
+import binascii
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import imaplib
 import io
+import itertools
 import poplib
+import queue
 import email
 import sqlite3
 import time
 import logging
 import re
+import tempfile
+import signal
+import sys
+import threading
 import traceback
 import zipfile
+import zstandard as zstd
 from cryptography.fernet import Fernet
 import os
 from datetime import datetime
+from email.parser import BytesHeaderParser
 from email.utils import parsedate_to_datetime
 from dateutil import parser
 from dotenv import load_dotenv
@@ -28,11 +40,36 @@ cipher_suite = Fernet(secret_key)
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def connect_database():
+    # Connect to the database. This will create the file if it does not exist.
+    # Archiver threads write concurrently, so wait for the write lock instead of failing.
+    conn = sqlite3.connect('email_archive.db', timeout=30)
+    cursor = conn.cursor()
+
+    # WAL lets the web interface and searches read while the archiver writes.
+    # It keeps email_archive.db-wal and email_archive.db-shm files next to the database.
+    # The database stays in its current mode if WAL is not available, e.g. on some network filesystems.
+    cursor.execute("PRAGMA journal_mode=WAL")
+    journal_mode = cursor.fetchone()[0]
+    if journal_mode != 'wal':
+        logging.warning(f"Could not enable WAL mode for the database, it uses journal mode {journal_mode}. Archiver writes may block readers.")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB memory map
+    return conn
+
+# Non-essential indexes, dropped while bulk archiving and recreated afterwards
+ATTACHMENTS_EMAIL_ID_INDEX = "CREATE INDEX IF NOT EXISTS attachments_email_id ON attachments (email_id)"
+EMAILS_FTS_INSERT_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS emails_ai AFTER INSERT ON emails BEGIN
+                                   INSERT INTO emails_fts (rowid, subject, sender, recipients, body)
+                                   VALUES (new.id, new.subject, new.sender, new.recipients, new.body);
+                               END'''
+
 def initialize_database():
     db_exists = os.path.exists('email_archive.db')
     if not db_exists:
-        # Connect to the database. This will create the file if it does not exist.
-        conn = sqlite3.connect('email_archive.db')
+        conn = connect_database()
         cursor = conn.cursor()
 
         # Create tables if they don't exist
@@ -61,6 +98,7 @@ def initialize_database():
                            email_id INTEGER,
                            filename TEXT,
                            content BLOB,
+                           compression TEXT DEFAULT 'none',
                            FOREIGN KEY (email_id) REFERENCES emails (id))''')
 
         cursor.execute('''CREATE TABLE IF NOT EXISTS email_uids
@@ -75,9 +113,67 @@ def initialize_database():
         logging.info("Database initialized successfully.")
     else:
         logging.info("Database already exists.")
+
+    # Create indexes if they don't exist, including on databases created before they were added.
+    # IMAP UIDs are only unique per mailbox, so emails are deduplicated per account.
+    conn = connect_database()
+    cursor = conn.cursor()
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS emails_account_unique_id ON emails (account_id, unique_id)")
+    cursor.execute(ATTACHMENTS_EMAIL_ID_INDEX)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS email_uids_account_uid ON email_uids (account_id, uid)")
+
+    # Fill the UID cache from IMAP emails archived before it existed. Their unique_id is
+    # the UID formatted as "b'<uid>'", so these emails are not fetched again.
+    cursor.execute('''INSERT OR IGNORE INTO email_uids (account_id, uid)
+                      SELECT emails.account_id, substr(emails.unique_id, 3, length(emails.unique_id) - 3)
+                      FROM emails JOIN accounts ON accounts.id = emails.account_id
+                      WHERE accounts.protocol = 'imap' AND emails.unique_id LIKE ?
+                      AND NOT EXISTS (SELECT 1 FROM email_uids)''', ("b'%",))
+
+    # Add the compression column to attachments tables created before it existed
+    cursor.execute("PRAGMA table_info(attachments)")
+    if 'compression' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE attachments ADD COLUMN compression TEXT DEFAULT 'none'")
+
+    # Full-text index used by search_emails, kept in sync with the emails table by triggers.
+    # The index is rebuilt if it is new, or if a bulk archive run was interrupted before
+    # recreating its insert trigger.
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN ('emails_fts', 'emails_ai')")
+    fts_complete = cursor.fetchone()[0] == 2
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5
+                      (subject, sender, recipients, body,
+                       content='emails', content_rowid='id', tokenize='unicode61 remove_diacritics 2')''')
+    cursor.execute(EMAILS_FTS_INSERT_TRIGGER)
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS emails_ad AFTER DELETE ON emails BEGIN
+                          INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipients, body)
+                          VALUES ('delete', old.id, old.subject, old.sender, old.recipients, old.body);
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS emails_au AFTER UPDATE ON emails BEGIN
+                          INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipients, body)
+                          VALUES ('delete', old.id, old.subject, old.sender, old.recipients, old.body);
+                          INSERT INTO emails_fts (rowid, subject, sender, recipients, body)
+                          VALUES (new.id, new.subject, new.sender, new.recipients, new.body);
+                      END''')
+    if not fts_complete:
+        # Index the emails archived without the full-text index
+        cursor.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+    conn.commit()
+    conn.close()
                    
 
 DEFAULT_PROTOCOL = 'pop3'  # Use POP3 as the default protocol
+FETCH_BATCH_SIZE = 100  # Number of emails per IMAP FETCH command and per queued write, kept small to stay below server request size limits
+IMAP_PIPELINE_DEPTH = 4  # Number of IMAP FETCH commands in flight on one connection
+ARCHIVER_MAX_WORKERS = 8  # Number of accounts archived in parallel
+BULK_ARCHIVE_THRESHOLD = 5000  # Number of new emails from which an account is archived in bulk mode
+WRITER_QUEUE_SIZE = 16  # Number of parsed batches waiting for the writer thread before the archiver workers block
+WRITER_MAX_BATCHES = 8  # Number of queued batches the writer thread commits in one transaction
+ATTACHMENT_STREAM_THRESHOLD = 1024 * 1024  # Base64 attachments larger than this are streamed into the database
+ATTACHMENT_CHUNK_SIZE = 64 * 1024  # Size of the decoded chunks written when streaming an attachment
+ATTACHMENT_COMPRESSION_LEVEL = 3  # zstd level used to compress attachments
+# Attachments in these formats are already compressed and stored as is
+COMPRESSED_ATTACHMENT_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.zip', '.gz', '.bz2', '.xz', '.7z', '.rar',
+                                  '.pdf', '.mp3', '.mp4', '.docx', '.xlsx', '.pptx')
 
 def parse_date(date_str):
     if date_str is None:
@@ -87,8 +183,406 @@ def parse_date(date_str):
         return date_tuple.strftime('%Y-%m-%d %H:%M:%S')
     except (TypeError, ValueError):
         return None
+
+def parse_imap_fetch_response(data):
+    # A FETCH response contains a (b'1 (UID 42 BODY[] {1234}', raw_email) tuple per message,
+    # followed by b')'. Some servers send the UID after the message literal instead.
+    messages = []
+    for item in data:
+        if isinstance(item, tuple):
+            match = re.search(rb'UID (\d+)', item[0])
+            messages.append([match.group(1) if match else None, item[1]])
+        elif isinstance(item, bytes) and messages and messages[-1][0] is None:
+            match = re.search(rb'UID (\d+)', item)
+            if match:
+                messages[-1][0] = match.group(1)
+    return [(uid, raw_email) for uid, raw_email in messages if uid is not None]
+
+def complete_imap_fetch(client, tag):
+    typ, data = client._command_complete('UID', tag)
+    _, data = client._untagged_response(typ, data, 'FETCH')
+    return [(uid, email.message_from_bytes(raw_email)) for uid, raw_email in parse_imap_fetch_response(data)]
+
+def fetch_imap_messages(client, email_uids):
+    # Fetch emails in batches to avoid one round trip per email. Up to IMAP_PIPELINE_DEPTH
+    # batch commands are sent before waiting for their responses (RFC 3501 section 5.5),
+    # so the server does not sit idle between batches. imaplib has no public API for this,
+    # so its internal command methods are used, like uid() does for a single command.
+    pending_tags = collections.deque()
+    for i in range(0, len(email_uids), FETCH_BATCH_SIZE):
+        batch = email_uids[i:i + FETCH_BATCH_SIZE]
+        # Only UIDs missing from the UID cache get here, so no separate header pass is needed
+        # to detect duplicates. BODY.PEEK[] returns the same content as RFC822 without
+        # setting the \Seen flag on the server.
+        pending_tags.append(client._command('UID', 'FETCH', b','.join(batch), '(UID BODY.PEEK[])'))
+        if len(pending_tags) == IMAP_PIPELINE_DEPTH:
+            yield complete_imap_fetch(client, pending_tags.popleft())
+    while pending_tags:
+        yield complete_imap_fetch(client, pending_tags.popleft())
+
+def retrieve_pop3_message(client, number):
+    _, lines, _ = client.retr(number)
+    return email.message_from_bytes(b'\n'.join(lines))
+
+def fetch_pop3_messages(client, email_uids):
+    # POP3 has no batch retrieval, but emails are still grouped to match the IMAP batches.
+    # email_uids holds (message number, UIDL) pairs.
+    for i in range(0, len(email_uids), FETCH_BATCH_SIZE):
+        yield [(uid, retrieve_pop3_message(client, number)) for number, uid in email_uids[i:i + FETCH_BATCH_SIZE]]
     
-def fetch_and_archive_emails(conn, account_id, protocol, server, port, username, encrypted_password, mailbox=None):
+def decode_header_value(value):
+    # Join the decoded parts of an encoded header value
+    decoded_parts = []
+    for part, encoding in email.header.decode_header(value):
+        if isinstance(part, bytes):
+            decoded_parts.append(part.decode(encoding or 'utf-8'))
+        else:
+            decoded_parts.append(part)
+    return ''.join(decoded_parts)
+
+def filter_legacy_pop3_emails(client, email_uids, legacy_unique_ids):
+    # Emails archived from POP3 before UIDLs were used have a unique_id built from their headers.
+    # Only the headers of the new emails are retrieved (TOP with no body lines) to recognize them,
+    # so they are not downloaded and parsed in full just to be skipped.
+    # Returns the emails still to archive and the (UIDL, legacy unique_id) pairs of the ones already archived.
+    header_parser = BytesHeaderParser()
+    top_supported = True
+    new_email_uids = []
+    legacy_matches = []
+    for number, uid in email_uids:
+        headers = None
+        if top_supported:
+            try:
+                headers = header_parser.parsebytes(b'\n'.join(client.top(number, 0)[1]))
+            except poplib.error_proto:
+                # TOP is optional in POP3, fall back to retrieving whole emails
+                logging.info("POP3 server does not support TOP. Retrieving whole emails instead.")
+                top_supported = False
+        if headers is None:
+            headers = retrieve_pop3_message(client, number)
+        subject = decode_header_value(headers['Subject'])
+        sender = decode_header_value(headers['From'])
+        legacy_unique_id = f"{headers['Message-ID']}_{headers['Date']}_{sender}_{subject}"
+        if legacy_unique_id in legacy_unique_ids:
+            legacy_matches.append((uid, legacy_unique_id))
+        else:
+            new_email_uids.append((number, uid))
+    return new_email_uids, legacy_matches
+
+def adopt_legacy_pop3_emails(conn, account_id, legacy_matches, legacy_unique_ids):
+    # Switch the emails archived with a legacy unique_id over to their UIDL, so they are
+    # recognized like any other email from now on
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE OR IGNORE emails SET unique_id = ? WHERE account_id = ? AND unique_id = ?",
+                       ((uid, account_id, legacy_unique_id) for uid, legacy_unique_id in legacy_matches))
+    cursor.executemany("INSERT OR IGNORE INTO email_uids (account_id, uid) VALUES (?, ?)",
+                       ((account_id, uid) for uid, _ in legacy_matches))
+    # All the UIDLs on the server were checked, so the legacy unique_ids left belong to emails
+    # that were deleted from it. They are recorded as known, so they are not looked for again.
+    matched_unique_ids = {legacy_unique_id for _, legacy_unique_id in legacy_matches}
+    cursor.executemany("INSERT OR IGNORE INTO email_uids (account_id, uid) VALUES (?, ?)",
+                       ((account_id, legacy_unique_id) for legacy_unique_id in legacy_unique_ids - matched_unique_ids))
+
+def is_streamed_attachment(part):
+    encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+    return encoding == 'base64' and len(part.get_payload()) > ATTACHMENT_STREAM_THRESHOLD
+
+def iter_base64_chunks(payload):
+    # Yield the base64 data of a payload in chunks, skipping line breaks and padding
+    chunk = []
+    chunk_size = 0
+    for match in re.finditer(r'[A-Za-z0-9+/]+', payload):
+        chunk.append(match.group())
+        chunk_size += match.end() - match.start()
+        if chunk_size >= ATTACHMENT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+def iter_decoded_base64(payload):
+    # Decode the base64 data of a payload chunk by chunk
+    pending = ''
+    for chunk in iter_base64_chunks(payload):
+        pending += chunk
+        usable = len(pending) // 4 * 4
+        yield binascii.a2b_base64(pending[:usable])
+        pending = pending[usable:]
+    # Pad the final incomplete group; a single leftover character carries no data
+    if len(pending) > 1:
+        yield binascii.a2b_base64(pending + '=' * (4 - len(pending)))
+
+def is_compressible_attachment(filename):
+    return not filename.lower().endswith(COMPRESSED_ATTACHMENT_SUFFIXES)
+
+def compress_attachment(filename, content):
+    # Compress attachments with zstd unless their format is already compressed.
+    # Attached emails (message/rfc822 parts) have no decoded payload and are stored as NULL.
+    if content is None or not is_compressible_attachment(filename):
+        return content, 'none'
+    return zstd.ZstdCompressor(level=ATTACHMENT_COMPRESSION_LEVEL).compress(content), 'zstd'
+
+def decompress_attachment(content, compression):
+    if compression == 'zstd':
+        # Streamed attachments are compressed without their size in the frame header,
+        # which ZstdDecompressor.decompress() requires
+        return zstd.ZstdDecompressor().decompressobj().decompress(content)
+    return content
+
+def spool_streamed_attachment(filename, part):
+    # Decode a large attachment chunk by chunk into a temporary file, compressing it on the way
+    # unless its format is already compressed. Only ATTACHMENT_STREAM_THRESHOLD bytes are kept
+    # in memory, the rest is spilled to disk until the writer copies it into the database.
+    content = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_STREAM_THRESHOLD)
+    chunks = iter_decoded_base64(part.get_payload())
+    if is_compressible_attachment(filename):
+        compressor = zstd.ZstdCompressor(level=ATTACHMENT_COMPRESSION_LEVEL).compressobj()
+        for chunk in chunks:
+            content.write(compressor.compress(chunk))
+        content.write(compressor.flush())
+        return content, 'zstd'
+    for chunk in chunks:
+        content.write(chunk)
+    return content, 'none'
+
+def save_streamed_attachment(conn, email_id, filename, content, compression):
+    # Copy a spooled attachment chunk by chunk into a preallocated BLOB, instead of
+    # reading it into memory whole and copying it again into SQLite
+    size = content.seek(0, io.SEEK_END)
+    content.seek(0)
+    cursor = conn.cursor()
+    cursor.execute('''INSERT INTO attachments (email_id, filename, content, compression)
+                      VALUES (?, ?, zeroblob(?), ?)''', (email_id, filename, size, compression))
+    with conn.blobopen('attachments', 'content', cursor.lastrowid) as blob:
+        for chunk in iter(lambda: content.read(ATTACHMENT_CHUNK_SIZE), b''):
+            blob.write(chunk)
+
+def write_transaction(conn, writes):
+    # Run the given (function, args) writes in one transaction. The write lock is taken
+    # up front, so the transaction never has to upgrade its lock.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for function, args in writes:
+            function(conn, *args)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def archive_batch(conn, email_rows, uid_rows, attachments):
+    # Write a batch of parsed emails, preparing each statement once
+    cursor = conn.cursor()
+    # Emails inserted by this batch get ids above the current maximum. Attachments are
+    # only linked to those, not to an email another archiver run inserted meanwhile.
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM emails")
+    previous_max_id = cursor.fetchone()[0]
+    cursor.executemany('''INSERT OR IGNORE INTO emails (account_id, subject, sender, recipients, date, body, unique_id)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)''', email_rows)
+    cursor.executemany("INSERT OR IGNORE INTO email_uids (account_id, uid) VALUES (?, ?)", uid_rows)
+    
+    # Large attachments are streamed one by one from their temporary file, runs of the others
+    # are inserted together. Both were already decoded and compressed by the archiver worker.
+    for streamed, group in itertools.groupby(attachments, key=lambda attachment: isinstance(attachment[3], tempfile.SpooledTemporaryFile)):
+        if streamed:
+            for account_id, unique_id, filename, content, compression in group:
+                cursor.execute("SELECT id FROM emails WHERE account_id = ? AND unique_id = ? AND id > ?", (account_id, unique_id, previous_max_id))
+                row = cursor.fetchone()
+                if row:
+                    save_streamed_attachment(conn, row[0], filename, content, compression)
+        else:
+            cursor.executemany('''INSERT INTO attachments (email_id, filename, content, compression)
+                                  SELECT id, ?, ?, ? FROM emails WHERE account_id = ? AND unique_id = ? AND id > ?''',
+                               ((filename, content, compression, account_id, unique_id, previous_max_id)
+                                for account_id, unique_id, filename, content, compression in group))
+
+# Number of accounts currently archived in bulk mode
+bulk_archive_count = 0
+bulk_archive_lock = threading.Lock()
+
+def drop_bulk_indexes(conn):
+    # Drop the non-essential indexes, so a large import does not update them for every email.
+    # The unique indexes stay in place, they are needed to detect duplicates.
+    logging.info("Dropping non-essential indexes for bulk archiving.")
+    cursor = conn.cursor()
+    cursor.execute("DROP INDEX IF EXISTS attachments_email_id")
+    cursor.execute("DROP TRIGGER IF EXISTS emails_ai")
+
+def rebuild_bulk_indexes(conn):
+    # Recreate the indexes in one pass. Rebuilding the full-text index also covers
+    # the emails other accounts archived in the meantime.
+    logging.info("Rebuilding indexes after bulk archiving.")
+    cursor = conn.cursor()
+    cursor.execute(ATTACHMENTS_EMAIL_ID_INDEX)
+    cursor.execute(EMAILS_FTS_INSERT_TRIGGER)
+    cursor.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+
+def begin_bulk_archive(conn, writer=None):
+    # The indexes are dropped by the first concurrent bulk import...
+    global bulk_archive_count
+    with bulk_archive_lock:
+        bulk_archive_count += 1
+        if bulk_archive_count == 1:
+            submit_write(conn, writer, drop_bulk_indexes)
+
+def end_bulk_archive(conn, writer=None):
+    # ...and only rebuilt once the last one has finished
+    global bulk_archive_count
+    with bulk_archive_lock:
+        bulk_archive_count -= 1
+        if bulk_archive_count == 0:
+            submit_write(conn, writer, rebuild_bulk_indexes)
+
+class SqliteWriter(threading.Thread):
+    # Single thread owning the database writes of an archiving cycle. The archiver workers
+    # queue their batches, and the batches queued meanwhile are committed together, so only
+    # this thread ever waits on the write lock.
+    def __init__(self):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self.close_lock = threading.Lock()
+        self.closed = False
+        self.error = None
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def submit(self, function, *args):
+        # Blocks while the queue is full, so fetching cannot run far ahead of the writes
+        if self.error is not None:
+            raise RuntimeError("The database writer thread failed.") from self.error
+        self.queue.put((function, args))
+    
+    def close(self):
+        # Write what is still queued and stop the thread
+        with self.close_lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise RuntimeError("The database writer thread failed.") from self.error
+    
+    def run(self):
+        try:
+            conn = connect_database()
+        except Exception as e:
+            self.error = e
+            logging.error(f"An error occurred while connecting the database writer: {str(e)}")
+            # Keep taking the queued writes until closed, so the archiver workers are not blocked forever
+            while self.queue.get() is not None:
+                pass
+            return
+        try:
+            while True:
+                # Wait for a write, then take the ones queued meanwhile
+                writes = [self.queue.get()]
+                while writes[-1] is not None and len(writes) < WRITER_MAX_BATCHES:
+                    try:
+                        writes.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stopping = writes[-1] is None
+                if stopping:
+                    writes.pop()
+                self.write(conn, writes)
+                if stopping:
+                    return
+        finally:
+            conn.close()
+    
+    def write(self, conn, writes):
+        if not writes:
+            return
+        try:
+            write_transaction(conn, writes)
+            logging.info(f"Wrote {len(writes)} queued batches to the database.")
+        except Exception:
+            # Retry them one by one, so a failing batch does not discard the others
+            for write in writes:
+                try:
+                    write_transaction(conn, [write])
+                except Exception as e:
+                    logging.error(f"An error occurred while writing to the database: {str(e)}")
+                    logging.error(f"Exception details: {traceback.format_exc()}")
+
+def submit_write(conn, writer, function, *args):
+    # Queue the write for the writer thread, or write it right away without one
+    if writer is not None:
+        writer.submit(function, *args)
+    else:
+        write_transaction(conn, [(function, args)])
+
+def read_ahead(batches):
+    # Fetch the next batch on a background thread while the current one is parsed and
+    # written, so waiting on the mail server overlaps with decoding and database writes.
+    # Only one batch is in flight at a time, so the mail client is never used concurrently,
+    # as long as the caller closes the generator before using the client again.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_batch = executor.submit(next, batches, None)
+        while True:
+            batch = next_batch.result()
+            if batch is None:
+                return
+            next_batch = executor.submit(next, batches, None)
+            yield batch
+
+# IMAP connections kept open between archiving cycles, keyed by (server, port, username)
+imap_clients = {}
+imap_clients_lock = threading.Lock()
+
+def get_imap_client(server, port, username, password):
+    # Reuse the cached connection if it is still alive, otherwise log in again.
+    # The connection is taken out of the cache so no other thread can use it meanwhile.
+    with imap_clients_lock:
+        client = imap_clients.pop((server, port, username), None)
+    if client is not None:
+        try:
+            client.noop()
+            return client
+        except (imaplib.IMAP4.error, OSError):
+            logging.info(f"Cached IMAP connection for {username} was dropped. Reconnecting.")
+            try:
+                client.shutdown()
+            except OSError:
+                pass
+    client = imaplib.IMAP4_SSL(server, port)
+    client._mode_utf8() 
+    client.login(username, password)
+    return client
+
+def release_imap_client(server, port, username, client):
+    with imap_clients_lock:
+        replaced_client = imap_clients.get((server, port, username))
+        imap_clients[(server, port, username)] = client
+    if replaced_client is not None:
+        logout_imap_client(replaced_client)
+
+def logout_imap_client(client):
+    # Log out of a connection that is not kept, closing its socket if the server does not answer
+    try:
+        client.logout()
+    except (imaplib.IMAP4.error, OSError):
+        try:
+            client.shutdown()
+        except OSError:
+            pass
+
+def close_imap_clients():
+    with imap_clients_lock:
+        clients = list(imap_clients.values())
+        imap_clients.clear()
+    for client in clients:
+        logout_imap_client(client)
+
+atexit.register(close_imap_clients)
+
+def fetch_and_archive_emails(conn, account_id, protocol, server, port, username, encrypted_password, mailbox=None, bulk=None, writer=None):
+    client = None
     try:
         logging.info(f"Started email archiving for account {account_id}.")
         if not isinstance(encrypted_password, bytes):
@@ -98,159 +592,171 @@ def fetch_and_archive_emails(conn, account_id, protocol, server, port, username,
             password = cipher_suite.decrypt(encrypted_password).decode()
         except InvalidTokenError as e:
             print("Decryption Error:", str(e))
+        cursor = conn.cursor()
+        
+        # Load the server UIDs that were already archived for this account
+        cursor.execute("SELECT uid FROM email_uids WHERE account_id = ?", (account_id,))
+        known_uids = {row[0] for row in cursor.fetchall()}
+        
         if protocol == 'imap':
-            # Connect to the IMAP server
-            client = imaplib.IMAP4_SSL(server, port)
-            client._mode_utf8() 
-            client.login(username, password)
+            # Connect to the IMAP server, reusing the connection from the previous cycle
+            client = get_imap_client(server, port, username, password)
             
             # Select the mailbox to fetch emails from
             client.select(mailbox, readonly=True)
             
-            # Fetch email UIDs
+            # Fetch email UIDs and only keep the ones that were not archived yet
             _, data = client.uid('search', None, 'ALL')
-            email_uids = data[0].split()
+            email_uids = [uid for uid in data[0].split() if uid.decode() not in known_uids]
         elif protocol == 'pop3':
             # Connect to the POP3 server
             client = poplib.POP3_SSL(server, port)
             client.user(username)
             client.pass_(password)
             
-            # Get the number of emails
-            num_emails = len(client.list()[1])
-            email_uids = range(1, num_emails + 1)
+            # Fetch the server assigned UIDLs and only keep the ones that were not archived yet
+            email_uids = []
+            for line in client.uidl()[1]:
+                number, uid = line.decode().split(' ', 1)
+                if uid not in known_uids:
+                    email_uids.append((int(number), uid))
         
-        logging.info(f"Found {len(email_uids)} emails for account {account_id}.")
+        logging.info(f"Found {len(email_uids)} new emails for account {account_id}.")
         
-        cursor = conn.cursor()
+        # Load the unique ids of the already archived emails once, so duplicates are detected
+        # without querying the database for every email
+        known_unique_ids = set()
+        if email_uids:
+            cursor.execute("SELECT unique_id FROM emails WHERE account_id = ?", (account_id,))
+            known_unique_ids = {row[0] for row in cursor.fetchall()}
         
-        for uid in email_uids:
-            logging.debug(f"Processing email with UID {uid} for account {account_id}.")
-            
-            if protocol == 'imap':
-                # Fetch the email content using IMAP
-                _, data = client.uid('fetch', uid, '(RFC822)')
-                raw_email = data[0][1]
-            elif protocol == 'pop3':
-                # Fetch the email content using POP3
-                raw_email = b'\n'.join(client.retr(uid)[1])
-            
-            # Parse the email content
-            email_message = email.message_from_bytes(raw_email)
-            
-            # Extract email metadata
-            subject_parts = email.header.decode_header(email_message['Subject'])
-            decoded_subject_parts = []
-            for part, encoding in subject_parts:
-                if isinstance(part, bytes):
-                    decoded_subject_parts.append(part.decode(encoding or 'utf-8'))
-                else:
-                    decoded_subject_parts.append(part)
-            subject = ''.join(decoded_subject_parts)
-
-            sender_parts = email.header.decode_header(email_message['From'])
-            decoded_sender_parts = []
-            for part, encoding in sender_parts:
-                if isinstance(part, bytes):
-                    decoded_sender_parts.append(part.decode(encoding or 'utf-8'))
-                else:
-                    decoded_sender_parts.append(part)
-            sender = ''.join(decoded_sender_parts)
-
-            # Check if 'To' header is None before decoding
-            if email_message['To'] is not None:
-                recipients_parts = email.header.decode_header(email_message['To'])
-                decoded_recipients_parts = []
-                for part, encoding in recipients_parts:
-                    if isinstance(part, bytes):
-                        decoded_recipients_parts.append(part.decode(encoding or 'utf-8'))
-                    else:
-                        decoded_recipients_parts.append(part)
-                recipients = ''.join(decoded_recipients_parts)
-            else:
-                recipients = ""  # empty string if no recipients ""
-
-            date = email_message['Date']
-            message_id = email_message['Message-ID']
-            
-            # Create a unique identifier for the email
-            if protocol == 'imap':
-                unique_id = str(uid)
-            elif protocol == 'pop3':
-                unique_id = f"{message_id}_{date}_{sender}_{subject}"
-            
-            # Check if the email already exists in the database
-            cursor.execute("SELECT id FROM emails WHERE unique_id = ?", (unique_id,))
-            existing_email = cursor.fetchone()
-            if existing_email:
-                logging.debug(f"Skipping email with UID {uid} for account {account_id} as it already exists.")
-                continue  # Skip archiving if the email already exists
-            
-            # Extract email body
-            body = ''
-            if email_message.is_multipart():
-                for part in email_message.walk():
-                    content_type = part.get_content_type()
-                    if content_type == 'text/plain' or content_type == 'text/html':
-                        payload = part.get_payload(decode=True)
-                        charset = part.get_content_charset()
-                        if charset:
-                            body += payload.decode(charset, errors='replace')
-                        else:
-                            body += payload.decode(errors='replace')
-            else:
-                payload = email_message.get_payload(decode=True)
-                charset = email_message.get_content_charset()
-                if charset:
-                    body = payload.decode(charset, errors='replace')
-                else:
-                    body = payload.decode(errors='replace')
-            
-            # Insert email metadata into the database
-            parsed_date = parse_date(date)
-            cursor.execute('''INSERT INTO emails (account_id, subject, sender, recipients, date, body, unique_id)
-                              VALUES (?, ?, ?, ?, ?, ?, ?)''', (account_id, subject, sender, recipients, parsed_date, body, unique_id))
-            email_id = cursor.lastrowid
-            
-            logging.info(f"Inserted email with UID {uid} for account {account_id} into the database.")
-            
-            # Save attachments
-            for part in email_message.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                if part.get('Content-Disposition') is None:
-                    continue
-                
-                filename = part.get_filename()
-                if filename:
-                    filename_parts = email.header.decode_header(filename)
-                    decoded_filename_parts = []
-                    for filename_part, encoding in filename_parts:
-                        if isinstance(filename_part, bytes):
-                            decoded_filename_parts.append(filename_part.decode(encoding or 'utf-8'))
-                        else:
-                            decoded_filename_parts.append(filename_part)
-                    filename = ''.join(decoded_filename_parts)
+        if protocol == 'pop3':
+            # Give the emails archived with their legacy unique_id their UIDL, this only happens once
+            legacy_unique_ids = known_unique_ids - known_uids
+            if legacy_unique_ids:
+                email_uids, legacy_matches = filter_legacy_pop3_emails(client, email_uids, legacy_unique_ids)
+                logging.info(f"Skipping {len(legacy_matches)} emails for account {account_id} as they already exist.")
+                submit_write(conn, writer, adopt_legacy_pop3_emails, account_id, legacy_matches, legacy_unique_ids)
+        
+        if protocol == 'imap':
+            # Fetch the email content using IMAP
+            batches = fetch_imap_messages(client, email_uids)
+        elif protocol == 'pop3':
+            # Fetch the email content using POP3
+            batches = fetch_pop3_messages(client, email_uids)
+        batches = read_ahead(batches)
+        
+        # Archive large imports, such as the first run for a new account, in bulk mode
+        if bulk is None:
+            bulk = len(email_uids) > BULK_ARCHIVE_THRESHOLD
+        if bulk:
+            begin_bulk_archive(conn, writer)
+        
+        try:
+            # Parse each fetched batch first and then queue it for writing. The writer commits up to
+            # WRITER_MAX_BATCHES queued batches per transaction. This avoids one commit per row without
+            # holding the database write lock while waiting on the mail server or parsing.
+            for batch in batches:
+                email_rows = []
+                uid_rows = []
+                attachments = []
+                for uid, email_message in batch:
+                    logging.debug(f"Processing email with UID {uid} for account {account_id}.")
                     
-                    logging.info(f"Found attachment {filename} for email with UID {uid} for account {account_id}.")
-                    content = part.get_payload(decode=True)
-                    cursor.execute('''INSERT INTO attachments (email_id, filename, content)
-                                    VALUES (?, ?, ?)''', (email_id, filename, content))
+                    # Create a unique identifier for the email and the server UID to remember as archived.
+                    # Both only need the UID, so duplicates are skipped before any header is decoded.
+                    if protocol == 'imap':
+                        unique_id = str(uid)  # "b'<uid>'", as used for previously archived emails
+                        uid_row = (account_id, uid.decode())
+                    elif protocol == 'pop3':
+                        unique_id = uid
+                        uid_row = (account_id, uid)
                     
-                    logging.info(f"Saved attachment {filename} for email with UID {uid} for account {account_id}.")
+                    if unique_id in known_unique_ids:
+                        logging.debug(f"Skipping email with UID {uid} for account {account_id} as it already exists.")
+                        uid_rows.append(uid_row)
+                        continue  # Skip archiving if the email already exists
                     
-        conn.commit()
+                    try:
+                        # Extract email metadata
+                        subject = decode_header_value(email_message['Subject'])
+                        sender = decode_header_value(email_message['From'])
+
+                        # Check if 'To' header is None before decoding
+                        if email_message['To'] is not None:
+                            recipients = decode_header_value(email_message['To'])
+                        else:
+                            recipients = ""  # empty string if no recipients ""
+
+                        date = email_message['Date']
+                        
+                        # Walk the MIME tree once, collecting the body text and the attachments.
+                        # The decoded body parts are joined once at the end.
+                        body_parts = []
+                        email_attachments = []
+                        for part in email_message.walk():
+                            if part.get_content_maintype() == 'multipart':
+                                continue
+                            
+                            if part.get('Content-Disposition') is not None and part.get_filename():
+                                filename = decode_header_value(part.get_filename())
+                                logging.info(f"Found attachment {filename} for email with UID {uid} for account {account_id}.")
+                                # Decode and compress here, so the writer only inserts the stored content
+                                if is_streamed_attachment(part):
+                                    email_attachments.append((account_id, unique_id, filename, *spool_streamed_attachment(filename, part)))
+                                else:
+                                    email_attachments.append((account_id, unique_id, filename, *compress_attachment(filename, part.get_payload(decode=True))))
+                                continue
+                            
+                            # Single part emails are archived as body whatever their content type. An attached
+                            # email (message/rfc822) has no payload of its own, its text parts are walked instead.
+                            content_type = part.get_content_type()
+                            if content_type == 'text/plain' or content_type == 'text/html' or (part is email_message and not part.is_multipart()):
+                                payload = part.get_payload(decode=True)
+                                if payload is None:
+                                    continue
+                                charset = part.get_content_charset()
+                                if charset:
+                                    body_parts.append(payload.decode(charset, errors='replace'))
+                                else:
+                                    body_parts.append(payload.decode(errors='replace'))
+                        body = ''.join(body_parts)
+                        
+                        parsed_date = parse_date(date)
+                    except Exception as e:
+                        # Skip the email without remembering its UID, so it is retried in the next cycle
+                        logging.error(f"An error occurred while parsing email with UID {uid} for account {account_id}: {str(e)}")
+                        logging.error(f"Exception details: {traceback.format_exc()}")
+                        continue
+                    
+                    email_rows.append((account_id, subject, sender, recipients, parsed_date, body, unique_id))
+                    uid_rows.append(uid_row)
+                    attachments.extend(email_attachments)
+                    known_unique_ids.add(unique_id)
+                
+                submit_write(conn, writer, archive_batch, email_rows, uid_rows, attachments)
+                logging.info(f"Archived {len(email_rows)} emails with {len(attachments)} attachments for account {account_id}.")
+        finally:
+            # Wait for the batch still being fetched, before the client is closed or logged out
+            batches.close()
+            if bulk:
+                end_bulk_archive(conn, writer)
         
         # Close the connection
         if protocol == 'imap':
+            # Only close the mailbox and keep the connection for the next cycle
             client.close()
-            client.logout()
+            release_imap_client(server, port, username, client)
         elif protocol == 'pop3':
             client.quit()
         
         logging.info(f"Email archiving completed successfully for account {account_id}.")
     
     except Exception as e:
+        conn.rollback()
+        # Do not keep a connection that may be in the middle of a command
+        if protocol == 'imap' and client is not None:
+            logout_imap_client(client)
         logging.error(f"An error occurred during email archiving for account {account_id}: {str(e)}")
         logging.error(f"Exception details: {traceback.format_exc()}")
 
@@ -420,24 +926,28 @@ def search_emails(conn, query):
                 logging.info("No valid search terms found. Returning no results.")
                 return []  # Return an empty list
 
-            # Build the SQL query dynamically based on the number of query terms
-            sql_query = "SELECT * FROM emails WHERE "
-            sql_conditions = []
-            sql_params = []
+            # Build a full-text query matching any of the terms as a word prefix in the subject,
+            # sender, recipients or body. Terms only contain word characters, so quoting them is safe.
+            match_query = " OR ".join(f'"{term}"*' for term in query_terms)
 
-            for term in query_terms:
-                sql_conditions.append("(LOWER(subject) LIKE ? OR LOWER(sender) LIKE ? OR LOWER(recipients) LIKE ? OR LOWER(body) LIKE ?)")
-                sql_params.extend([f"%{term}%", f"%{term}%", f"%{term}%", f"%{term}%"])
-
-            sql_query += " OR ".join(sql_conditions)
-
-            # Execute the SQL query with the dynamic conditions and parameters
-            cursor.execute(sql_query, sql_params)
+            # Execute the full-text query against the emails_fts index
+            cursor.execute('''SELECT emails.* FROM emails JOIN emails_fts ON emails_fts.rowid = emails.id
+                              WHERE emails_fts MATCH ? ORDER BY emails.id''', (match_query,))
 
     emails = cursor.fetchall()
     logging.info(f"Found {len(emails)} emails matching the search query.")
     return emails
 
+def get_attachment(conn, attachment_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT filename, content, compression FROM attachments WHERE id = ?", (attachment_id,))
+    attachment = cursor.fetchone()
+    if attachment:
+        filename, content, compression = attachment
+        return filename, decompress_attachment(content, compression)
+    else:
+        return None
+
 def get_email_details(conn, email_id):
     logging.info(f"Fetching email details for email ID {email_id}.")
     cursor = conn.cursor()
@@ -485,7 +995,7 @@ def get_email_details(conn, email_id):
 def run_archiver_once(account_id):
     try:
         logging.info(f"Starting email archiving for account {account_id}...")
-        conn = sqlite3.connect('email_archive.db')
+        conn = connect_database()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM accounts WHERE id = ?", (account_id,))
         account = cursor.fetchone()
@@ -500,16 +1010,34 @@ def run_archiver_once(account_id):
         logging.error(f"An error occurred during email archiving for account {account_id}: {str(e)}")
         logging.error(f"Exception details: {traceback.format_exc()}")
 
+def archive_account(account, writer):
+    # SQLite connections must not be shared between threads, so each account gets its own
+    # to read from. Its writes go through the shared writer thread.
+    conn = connect_database()
+    try:
+        account_id, email, encrypted_password, protocol, server, port, mailbox = account
+        fetch_and_archive_emails(conn, account_id, protocol, server, port, email, encrypted_password, mailbox, writer=writer)
+    finally:
+        conn.close()
+
 def run_archiver():
+    # Bring an existing archive up to the current schema, the archiver can run without the web app
+    initialize_database()
     while True:
         try:
             logging.info("Starting email archiving cycle...")
-            conn = sqlite3.connect('email_archive.db')
+            conn = connect_database()
             accounts = read_accounts(conn)
-            for account in accounts:
-                account_id, email, encrypted_password, protocol, server, port, mailbox = account
-                fetch_and_archive_emails(conn, account_id, protocol, server, port, email, encrypted_password, mailbox)
             conn.close()
+            # Archive accounts in parallel, their time is mostly spent waiting on the mail servers.
+            # The queued writes are flushed when the cycle ends or the process exits.
+            with SqliteWriter() as writer:
+                atexit.register(writer.close)
+                try:
+                    with ThreadPoolExecutor(max_workers=ARCHIVER_MAX_WORKERS) as executor:
+                        list(executor.map(archive_account, accounts, itertools.repeat(writer)))
+                finally:
+                    atexit.unregister(writer.close)
             logging.info("Email archiving cycle completed.")
             time.sleep(300)  # Wait for 5 minutes before the next archiving cycle
         except Exception as e:
@@ -578,6 +1106,8 @@ if __name__ == '__main__':
         else:
             print(f"Email with ID {args.email_id} not found.")
     elif args.command == 'run_archiver':
+        # Exit normally on SIGTERM, so the writes still queued are flushed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         run_archiver()
 
     logging.info(f"Command {args.command} executed successfully.")